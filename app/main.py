@@ -1,144 +1,273 @@
 import sys
 import os
 import subprocess
-import shlex
+import re
 import readline
-from typing import Callable, Optional
-
-
-builtin_commands:dict[str,Callable[[str],None]]={}
-_executables_cache:set[str]|None=None
-last_appended_index:int=0
-initial_history_length:int=0
+import bisect
+import stat
+import threading
+from contextlib import ExitStack,redirect_stdout,redirect_stderr
+from typing import IO, Callable, Optional
+
+
+# redirection operator -> (stream it redirects, file open mode)
+_REDIR_MAP:dict[str,tuple[str,str]]={
+    ">":("stdout","w"), # file descriptor 1, for sending output to output file, write mode
+    "1>":("stdout","w"),
+    ">>":("stdout","a"), # file descriptor 1, for sending output to output file, append mode
+    "1>>":("stdout","a"),
+    "2>":("stderr","w"), # file descriptor 2, for sending errors to output file, write mode
+    "2>>":("stderr","a") # file descriptor 2, for sending errors to output file, append mode
+}
+
+# one shell word: a run of single quoted, double quoted, backslash escaped or plain pieces, with no whitespace in between
+# a '#' starting a word comments out the rest of the line, any other match of 'bad' is an unclosed quote or a trailing '\'
+_TOKEN_RE=re.compile(r"""(?P<comment>#.*)|(?P<word>(?:'[^']*'|"(?:\\.|[^"\\])*"|\\.|[^\s'"\\])+)|(?P<bad>\S)""",re.DOTALL)
+# the pieces of a single word, to remove the quotes and escapes from
+_PIECE_RE=re.compile(r"""'([^']*)'|"((?:\\.|[^"\\])*)"|\\(.)|([^'"\\]+)""",re.DOTALL)
+# inside double quotes a backslash only escapes another backslash or a double quote
+_DQUOTE_ESCAPE_RE=re.compile(r'\\(["\\])')
+
+builtin_commands:dict[str,Callable[[list[str]],None]]={} # builtins get their arguments as a list, without the command name
+_executables_cache:dict[str,tuple[int,frozenset[str]]]={} # directory -> (mtime_ns, executable names)
+_executables_cache_path:Optional[str]=None # PATH string the cache was built for
+_executables_lock=threading.Lock() # the cache is warmed on a background thread at startup, while Tab may already be pressed
+_sorted_completions:list[str]=[] # builtins and executables, sorted so prefixes can be found with bisect
+_by_first:dict[str,list[str]]={} # first character -> the sorted completions starting with it
+_executables_cache_id:int=0 # bumped every time the sorted completions are rebuilt
+_last_completer_text:Optional[str]=None # text the completer options were computed for
+_last_completer_options:list[str]=[]
+_last_completer_cache_id:int=-1 # _executables_cache_id the completer options were computed with
+_find_exec_cache:dict[str,str]={} # command -> full path, only for commands that were found
+_find_exec_path_snapshot:Optional[str]=None # PATH string the lookups were done with
+_HOME_ENV:Optional[str]=os.environ.get("HOME") # HOME value _HOME was expanded from
+_HOME:str=os.path.expanduser("~")
+# (PATH value, its directories) kept in one tuple, so the warm up thread and the main thread never see them half updated
+_PATH_SPLIT:tuple[str,list[str]]=("",[""])
+_warmup_thread:Optional[threading.Thread]=None # scans PATH at startup, see main()
+_pending_history:list[str]=[] # commands entered in this session, in order
+last_appended_index:int=0 # how many of _pending_history the last history -a already wrote
+_HISTFILE:Optional[str]=None # HISTFILE as it was at startup, set by load_history
 
 # add to HISTFILE before exiting
 def write_to_history_file()->None:
-    histfile=os.environ.get("HISTFILE")
-    if not histfile:
+    if not _HISTFILE:
         return
-    total=int(readline.get_current_history_length())  # type: ignore
-    new_lines=int(total-initial_history_length)
-    if new_lines>0:
-        readline.append_history_file(new_lines,histfile)  # type: ignore
+    if _pending_history:
+        with open(_HISTFILE,"a") as f:
+            f.write("\n".join(_pending_history)+"\n") # one write for the whole session, no seeking per entry
 
-def exit_shell(input:str)->None:
+def exit_shell(args:list[str])->None:
     write_to_history_file()
-    if input.strip().isdigit():
-        sys.exit(int(input))   # exit with given status code
+    if args and args[0].isdigit():
+        sys.exit(int(args[0]))   # exit with given status code
     else:
         sys.exit(0)  
 
-def echo(input:str)->None:
-    print(input)
+def echo(args:list[str])->None:
+    print(" ".join(args))
 
-def get_cwd(_:str)->None:
+def get_cwd(_:list[str])->None:
     print(os.getcwd())
 
 
+def _get_home()->str:
+    # home dir only needs expanding again if HOME itself was changed
+    global _HOME_ENV,_HOME
+    home_env=os.environ.get("HOME")
+    if home_env!=_HOME_ENV:
+        _HOME_ENV=home_env
+        _HOME=os.path.expanduser("~")
+    return _HOME
+
+def _get_path_dirs()->tuple[str,list[str]]:
+    # PATH is split again only when its value changed, otherwise the previous (PATH, directories) is returned
+    global _PATH_SPLIT
+    path=os.environ.get("PATH","")
+    path_split=_PATH_SPLIT # read once, the other thread may replace it meanwhile
+    if path!=path_split[0]:
+        path_split=(path,path.split(os.pathsep))
+        _PATH_SPLIT=path_split
+    return path_split
+
 def find_executable(cmd:str)->Optional[str]:
+    global _find_exec_path_snapshot
+    path,path_dirs=_get_path_dirs()
+    if path!=_find_exec_path_snapshot: # PATH changed, so earlier lookups may be wrong now
+        _find_exec_cache.clear()
+        _find_exec_path_snapshot=path
+    cached=_find_exec_cache.get(cmd) # remembered lookup, like the hash table of a real shell
+    if cached is not None:
+        return cached
+
     # going to all directories and checking if the file exists and is accessible for execution
-    path_dirs=os.environ.get("PATH","").split(os.pathsep)
     for directory in path_dirs:
-        if not os.path.isdir(directory): # normally only directories are present in PATH, but just in case if someone has put a file in PATH, then ignore it
-            continue
         full_path=os.path.join(directory,cmd)
-        if os.path.isfile(full_path) and os.access(full_path,os.X_OK):
+        # a single syscall for the misses, simply False if the directory or file does not exist
+        # only on a hit it is checked that its not a directory, since directories also have the execute bit
+        if os.access(full_path,os.X_OK) and not os.path.isdir(full_path):
+            _find_exec_cache[cmd]=full_path
             return full_path
-    return None
+    return None # not remembered, so a command installed later is found on the next lookup
 
-def typeOf(input:str)->None:
-    # checking if its a bulitin command
-    if input in builtin_commands:
-        print(f"{input} is a shell builtin")
-        return
-    
-    # checking if the input path exists and is an executable from the environment variables
-    executable_path=find_executable(input)
-    if executable_path:
-        print(f"{input} is {executable_path}")
+def hash_command(args:list[str])->None:
+    # hash -r forgets all the remembered command locations, same as rehash
+    if args==["-r"]:
+        rehash(args)
         return
+    # otherwise list the remembered command locations
+    for full_path in _find_exec_cache.values():
+        print(full_path)
+
+def typeOf(args:list[str])->None:
+    for name in args:
+        # checking if its a bulitin command
+        if name in builtin_commands:
+            print(f"{name} is a shell builtin")
+            continue
 
-    print(f"{input}: not found")
+        # checking if the input path exists and is an executable from the environment variables
+        executable_path=find_executable(name)
+        if executable_path:
+            print(f"{name} is {executable_path}")
+            continue
+
+        print(f"{name}: not found")
 
-def change_directory(input:str)->None:
-    if input=='~':
-        input=os.path.expanduser("~") # standard notation for home dir , so gives absolute path for home , in every OS
+def change_directory(args:list[str])->None:
+    target=args[0] if args else '~' # plain cd goes home too
+    if target=='~':
+        target=_get_home() # standard notation for home dir , so gives absolute path for home , in every OS
     try:
-        os.chdir(input)
+        os.chdir(target)
     except OSError:
-        print(f"cd: {input}: No such file or directory")
+        print(f"cd: {target}: No such file or directory")
 
 def get_all_executables()->set[str]:
-    global _executables_cache
-    if _executables_cache:
-        return _executables_cache
-    
+    # if the startup warm up is still scanning, this waits for it and then reuses what it cached
+    with _executables_lock:
+        return _scan_executables()
+
+def _scan_executables()->set[str]:
+    global _executables_cache_path,_executables_cache_id
+    changed=False # whether the sorted completions have to be rebuilt
+    path,path_dirs=_get_path_dirs()
+    if path!=_executables_cache_path: # PATH changed since last call, so drop every cached directory
+        _executables_cache.clear()
+        _executables_cache_path=path
+        changed=True
+
     executables:set[str]=set()
-    path_dirs=os.environ.get("PATH","").split(os.pathsep)
     for directory in path_dirs:
-        try: # only if the directory is accessible, otherwise os.listdir() will raise PermissionError
-            for filename in os.listdir(directory):
-                full_path=os.path.join(directory,filename)
-                if os.path.isfile(full_path) and os.access(full_path,os.X_OK):
-                    executables.add(filename)
-        except PermissionError:
+        try:
+            mtime_ns=os.stat(directory).st_mtime_ns
+        except OSError: # directory in PATH does not exist or is not accessible
+            if _executables_cache.pop(directory,None):
+                changed=True
+            continue
+        cached=_executables_cache.get(directory)
+        if cached and cached[0]==mtime_ns: # directory unchanged since last scan, so reuse its names
+            executables.update(cached[1])
+            continue
+
+        names:set[str]=set()
+        try: # only if its an accessible directory, otherwise os.scandir() raises PermissionError, NotADirectoryError, ...
+            with os.scandir(directory) as it:
+                for entry in it:
+                    # one stat (following symlinks, like /etc/alternatives ones) gives both the type and the execute bits
+                    try:
+                        st=entry.stat()
+                    except OSError: # broken symlink
+                        continue
+                    if stat.S_ISREG(st.st_mode) and st.st_mode&0o111:
+                        names.add(entry.name)
+        except OSError:
             continue
-    _executables_cache=executables
+        _executables_cache[directory]=(mtime_ns,frozenset(names))
+        executables.update(names)
+        changed=True
+
+    if changed or not _sorted_completions:
+        _sorted_completions[:]=sorted(executables.union(builtin_commands))
+        _by_first.clear()
+        for name in _sorted_completions: # appending in sorted order keeps every bucket sorted
+            _by_first.setdefault(name[0],[]).append(name)
+        _executables_cache_id+=1
     return executables
 
+def rehash(_:list[str])->None:
+    # forget all the cached PATH directories and command locations, next completion or lookup will scan them again
+    with _executables_lock:
+        _executables_cache.clear()
+    _find_exec_cache.clear()
+
 def auto_completer(text:str,state:int)->Optional[str]:
-    executables=get_all_executables()
-    builtin_options=[cmd for cmd in builtin_commands if cmd.startswith(text)] # taking all the possible keys in builtin_commands
-    executable_options=[exe for exe in executables if exe.startswith(text)] # taking all the possible executable commands , from filepaths in PATH
-    options=builtin_options+executable_options # total options to choose from
-    if state<len(options):
-        return options[state]+" " # cursor appears after completion and an extra space
+    global _last_completer_text,_last_completer_options,_last_completer_cache_id
+    if state==0: # readline asks with state 0 first, then 1,2,... until None is returned
+        get_all_executables() # picks up any PATH change, bumping _executables_cache_id if needed
+    if text!=_last_completer_text or _executables_cache_id!=_last_completer_cache_id:
+        # only names with the same first character can match, so search in that bucket
+        candidates=_by_first.get(text[0],[]) if text else _sorted_completions
+        # all names starting with text are next to each other in the sorted bucket, starting at bisect_left
+        i=bisect.bisect_left(candidates,text)
+        options:list[str]=[]
+        while i<len(candidates) and candidates[i].startswith(text):
+            options.append(candidates[i])
+            i+=1
+        _last_completer_text=text
+        _last_completer_options=options
+        _last_completer_cache_id=_executables_cache_id
+    if state<len(_last_completer_options):
+        return _last_completer_options[state]+" " # cursor appears after completion and an extra space
     return None
 
+def _unquote(word:str)->str:
+    parts:list[str]=[]
+    for single,double,escaped,plain in _PIECE_RE.findall(word):
+        if double:
+            parts.append(_DQUOTE_ESCAPE_RE.sub(r"\1",double))
+        else:
+            parts.append(single or escaped or plain) # at most one of them is non-empty
+    return "".join(parts)
+
 def parse_input(command:str)->list[str]:
-    # using shlex to parse commands like a real shell would do
-    lexer=shlex.shlex(command,posix=True) # posix=True tells to read the command like how Unix shell would read, if False then its like a normal parser
-    lexer.whitespace_split=True # split on whitespaces , except inside single quotes, specified in next line
-    # by default shlex treats single quotes as literal , does not touch it , and double quotes also , but allows escaping '\' when inside double quotes
-    # supports backslash(\) as well when inside double quotes or single quotes
-    tokens=list(lexer)
+    # tokenizing like a POSIX shell would do, with a regex compiled once so the scanning happens in C
+    # single quotes keep everything literal, double quotes allow escaping '\' and '"', outside quotes '\' escapes any character
+    if "'" not in command and '"' not in command and "\\" not in command and "#" not in command:
+        return command.split() # nothing to unquote or strip, so str.split() gives the same words
+    tokens:list[str]=[]
+    for match in _TOKEN_RE.finditer(command):
+        if match.lastgroup=="comment":
+            break
+        if match.lastgroup=="bad":
+            if match.group()=="\\":
+                raise ValueError("No escaped character")
+            raise ValueError("No closing quotation")
+        tokens.append(_unquote(match.group()))
     return tokens
 
 def extract_redirections(tokens:list[str])->tuple[list[str],Optional[str],str,Optional[str],str]:
     command:list[str]=[]
-    stdout_target:Optional[str]=None
-    stdout_mode:str="w" # by default
-    stderr_target:Optional[str]=None
-    stderr_mode:str="w" # by default
+    targets:dict[str,Optional[str]]={"stdout":None,"stderr":None}
+    modes:dict[str,str]={"stdout":"w","stderr":"w"} # write mode by default
 
     i=0
     while i<len(tokens):
         token=tokens[i]
-        if token in ['>',"1>"]: # file descriptor 1, for sending output to output file, write mode
-            stdout_target=tokens[i+1]
-            stdout_mode="w"
-            i+=2
-        elif token=="2>": # file descriptor 2, for sending errors to output file, write mode
-            stderr_target=tokens[i+1]
-            stderr_mode="w"
-            i+=2
-        elif token in [">>","1>>"]: # file descriptor 1, for sending output to output file, append mode
-            stdout_target=tokens[i+1]
-            stdout_mode="a"
-            i+=2
-        elif token=="2>>": # file descriptor 2, for sending errors to output file, append mode
-            stderr_target=tokens[i+1]
-            stderr_mode="a"
+        info=_REDIR_MAP.get(token) # a single dict lookup instead of comparing against every operator
+        if info:
+            target_name,mode=info
+            targets[target_name]=tokens[i+1]
+            modes[target_name]=mode
             i+=2
         else:
             command.append(token)
             i+=1
 
-    return command,stdout_target,stdout_mode,stderr_target,stderr_mode
+    return command,targets["stdout"],modes["stdout"],targets["stderr"],modes["stderr"]
 
-def get_history(input:str)->None:
+def get_history(args:list[str])->None:
     global last_appended_index
-    args=input.strip().split()
 
     # to read from a file , and adding it to history
     if len(args)==2 and args[0]=="-r": # read the commands in the specified path , and them to history too
@@ -158,11 +287,11 @@ def get_history(input:str)->None:
     # to append to a file, all the commands in the command history, since the last history -a
     if len(args)==2 and args[0]=="-a":
         file_path=args[1]
-        total=int(readline.get_current_history_length()) # type: ignore
+        new_lines=_pending_history[last_appended_index:]
         with open(file_path,"a") as f:
-            for i in range(last_appended_index+1,total+1):
-                f.write(readline.get_history_item(i)+"\n")  # type: ignore
-        last_appended_index=total
+            if new_lines:
+                f.write("\n".join(new_lines)+"\n") # all in one write, instead of one per command
+        last_appended_index=len(_pending_history)
         return
     
     # default: show all
@@ -171,11 +300,20 @@ def get_history(input:str)->None:
         n=int(args[0])
     total=readline.get_current_history_length() # type: ignore
     startindex=max(total-n,0) # type: ignore
-    for i in range(startindex+1,total+1): # type: ignore # 1-based indexing in get_history_item()
-        print(f"    {i}  {readline.get_history_item(i)}") # type: ignore
+    # 1-based indexing in get_history_item(), all lines written at once instead of a print per line
+    lines=[f"    {i}  {readline.get_history_item(i)}\n" for i in range(startindex+1,total+1)] # type: ignore
+    sys.stdout.write("".join(lines))
 
 
+def resolve(commandArr:list[str])->Optional[Callable[[list[str]],None]]:
+    # deciding once what the (non-empty) commandArr[0] is, so the caller can call a builtin directly without looking it up again
+    # the builtin's function, or None for an external command, which is left to execvp to find through PATH
+    return builtin_commands.get(commandArr[0])
+
 def execute_pipeline(stages:list[list[str]]):
+    # forking while the warm up thread is still scanning PATH is unsafe (and warned about from python 3.12), so wait for it
+    if _warmup_thread is not None:
+        _warmup_thread.join()
     prev_read_fd=None # to store the previous command's read end of pipe 
     num_cmds=len(stages)
     for i,tokens in enumerate(stages):
@@ -200,8 +338,11 @@ def execute_pipeline(stages:list[list[str]]):
                 os.close(r) # closing the original read since the child does not read anything from here
 
             # execution of the command , which is why created the child process for
-            if tokens[0] in builtin_commands:
-                builtin_commands[tokens[0]](" ".join(tokens[1:]))
+            if not tokens: # empty stage, nothing to run
+                os._exit(0)
+            builtin_fn=resolve(tokens)
+            if builtin_fn is not None:
+                builtin_fn(tokens[1:])
                 os._exit(0)  # must exit to avoid continuing parent logic
             else:
                 os.execvp(tokens[0],tokens) # replaces the whole child process , with this process
@@ -231,54 +372,36 @@ def handle_command(command:str)->None:
     # extracting any redirections for stdout,stderr , if any
     commandArr,stdout_target,stdout_mode,stderr_target,stderr_mode=extract_redirections(tokens)
 
-    # if its a builtin command
-    if commandArr[0] in builtin_commands:
-        # temporarily redirect stdout and/or stderr, and then back to console after the operation
-        if stdout_target and stderr_target:
-            with open(stdout_target,stdout_mode) as stdout_file, open(stderr_target,stderr_mode) as stderr_file:
-                old_stdout=sys.stdout
-                old_stderr=sys.stderr
-                sys.stdout=stdout_file
-                sys.stderr=stderr_file
-                builtin_commands[commandArr[0]](" ".join(commandArr[1:]))
-                sys.stdout=old_stdout
-                sys.stderr=old_stderr
-        elif stdout_target:
-            with open(stdout_target,stdout_mode) as stdout_file:
-                old_stdout=sys.stdout
-                sys.stdout=stdout_file
-                builtin_commands[commandArr[0]](" ".join(commandArr[1:]))
-                sys.stdout=old_stdout
-        elif stderr_target:
-            with open(stderr_target,stderr_mode) as stderr_file:
-                old_stderr=sys.stderr
-                sys.stderr=stderr_file
-                builtin_commands[commandArr[0]](" ".join(commandArr[1:]))
-                sys.stderr=old_stderr
-        else:
-            builtin_commands[commandArr[0]](" ".join(commandArr[1:]))
+    if not commandArr: # empty line, or only redirections
         return
 
-
-    # if its an external command
-    executable_path=find_executable(commandArr[0])
-    if executable_path:
-        # getting the execuatble and if needed the stdout_file and/or stderr_file for redirecting outputs and /or errors
-        if stdout_target and stderr_target:
-            with open(stdout_target,stdout_mode) as stdout_file, open(stderr_target,stderr_mode) as stderr_file:
-                subprocess.run(commandArr,executable=executable_path,stdout=stdout_file,stderr=stderr_file)
-        elif stdout_target:
-            with open(stdout_target,stdout_mode) as stdout_file:
-                subprocess.run(commandArr,executable=executable_path,stdout=stdout_file)
-        elif stderr_target:
-            with open(stderr_target,stderr_mode) as stderr_file:
-                subprocess.run(commandArr,executable=executable_path,stderr=stderr_file)
-        else:
-            subprocess.run(commandArr,executable=executable_path)
+    # if its a builtin command, called directly through the resolved function
+    builtin_fn=resolve(commandArr)
+    if builtin_fn is not None:
+        # temporarily redirect stdout and/or stderr, and the ExitStack puts them back and closes the files, even on errors
+        with ExitStack() as stack:
+            if stdout_target:
+                stack.enter_context(redirect_stdout(stack.enter_context(open(stdout_target,stdout_mode))))
+            if stderr_target:
+                stack.enter_context(redirect_stderr(stack.enter_context(open(stderr_target,stderr_mode))))
+            builtin_fn(commandArr[1:])
         return
 
-        
-    print(f"{commandArr[0]}: command not found")
+
+    # if its an external command, subprocess resolves it through PATH itself (execvp), so no lookup of our own here
+    # getting the stdout_file and/or stderr_file if needed, for redirecting outputs and /or errors
+    with ExitStack() as stack:
+        kwargs:dict[str,IO[str]]={} # stdout and/or stderr files for subprocess.call
+        if stdout_target:
+            kwargs["stdout"]=stack.enter_context(open(stdout_target,stdout_mode))
+        if stderr_target:
+            kwargs["stderr"]=stack.enter_context(open(stderr_target,stderr_mode))
+        try:
+            subprocess.call(commandArr,**kwargs) # no CompletedProcess needed, only waiting for it
+        except FileNotFoundError:
+            print(f"{commandArr[0]}: command not found")
+        except PermissionError: # found, but not executable
+            print(f"{commandArr[0]}: Permission denied")
 
 def _init_builtins()->None:
      builtin_commands.update({
@@ -287,7 +410,9 @@ def _init_builtins()->None:
         "type":typeOf,
         "pwd":get_cwd,
         "cd":change_directory,
-        "history":get_history
+        "history":get_history,
+        "rehash":rehash,
+        "hash":hash_command
     })
      
 def readline_config()->None:
@@ -300,11 +425,13 @@ def readline_config()->None:
     readline.set_auto_history(False) # type: ignore
 
 def load_history()->None:
-    global initial_history_length
-    histfile=os.environ.get("HISTFILE")
-    if histfile and os.path.isfile(histfile):
-        readline.read_history_file(histfile)  # type: ignore
-    initial_history_length=readline.get_current_history_length() # type: ignore
+    global _HISTFILE
+    _HISTFILE=os.environ.get("HISTFILE") # read once, later changes to HISTFILE do not redirect the history
+    if _HISTFILE and os.access(_HISTFILE,os.R_OK):
+        try:
+            readline.read_history_file(_HISTFILE)  # type: ignore
+        except OSError: # removed between the check and the read, or not a regular file (e.g. a directory)
+            pass
 
 
 def main()->None:
@@ -315,6 +442,11 @@ def main()->None:
     # readline config
     readline_config()
 
+    # scanning PATH for completions in the background, so the first <TAB> does not have to wait for it
+    global _warmup_thread
+    _warmup_thread=threading.Thread(target=get_all_executables,daemon=True)
+    _warmup_thread.start()
+
     # loading history into memory, if history file is specified in HISTFILE
     load_history()
     
@@ -323,6 +455,7 @@ def main()->None:
         command=input("$ ")
         if command.strip():  # only add non-empty commands
             readline.add_history(command)   # type: ignore
+            _pending_history.append(command)
         handle_command(command)
 
 